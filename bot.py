@@ -1,10 +1,16 @@
 import os
+import io
 import logging
-import tempfile
 import asyncio
 import time
+import hashlib
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import google.generativeai as genai
+from google.api_core.exceptions import NotFound, PermissionDenied, ResourceExhausted
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential
 from telegram import Update
 from telegram.constants import ParseMode
 from telegram.ext import ApplicationBuilder, ContextTypes, MessageHandler, CommandHandler, filters
@@ -14,6 +20,10 @@ load_dotenv()
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+# Max in-flight Gemini requests across all users
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "4"))
+# Worker threads for blocking calls (hashing, uploads)
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", "8"))
 
 # Configure logging
 logging.basicConfig(
@@ -28,36 +38,14 @@ if GEMINI_API_KEY:
     
 # Constants
 MODEL_NAME = "gemini-2.0-flash" 
-
-async def process_pdf(pdf_path: str) -> str:
-    """Uploads PDF to Gemini and gets the editorial analysis."""
-    logger.info(f"Uploading file to Gemini: {pdf_path}")
-    
-    # Upload file
-    # We must run this in a thread because it's synchronous IO
-    loop = asyncio.get_running_loop()
-    
-    # Define a helper for the blocking upload call
-    def upload_and_wait():
-        sample_file = genai.upload_file(pdf_path, mime_type="application/pdf")
-        # Wait for processing to complete. 
-        # For small PDFs it's instant, but safe to check.
-        while sample_file.state.name == "PROCESSING":
-             time.sleep(1)
-             sample_file = genai.get_file(sample_file.name)
-        return sample_file
-
-    gemini_file = await loop.run_in_executor(None, upload_and_wait)
-    
-    if gemini_file.state.name == "FAILED":
-        raise ValueError("Gemini failed to process the PDF file.")
-        
-    logger.info(f"File uploaded: {gemini_file.name}")
-    
-    # Generate content
-    model = genai.GenerativeModel(MODEL_NAME)
-    
-    prompt = """
+# Gemini deletes uploaded files after 48h; stop reusing them an hour early
+FILE_CACHE_TTL = 47 * 60 * 60
+# Finished briefs are kept on disk so re-sent newspapers skip Gemini entirely
+SUMMARY_CACHE_DIR = Path(tempfile.gettempdir()) / "editorial_bot_cache"
+SUMMARY_CACHE_MAX_BYTES = 50 * 1024 * 1024
+NOT_FOUND_REPLY = "Could not locate editorial section."
+
+BRIEF_PROMPT = f"""
     You are an expert policy analyst. Using the attached newspaper document:
     
     1.  **Locate** the "Editorial", "Opinion", or "Ideas" section (usually in the middle pages).
@@ -69,15 +57,133 @@ async def process_pdf(pdf_path: str) -> str:
         *   **Policy Implications:** (Relevance for a senior government official).
     
     Format the output in clean Markdown with bold headers and bullet points.
-    If you cannot find the editorials, say "Could not locate editorial section."
+    If you cannot find the editorials, say "{NOT_FOUND_REPLY}"
     """
+# Part of the brief cache key, so editing the prompt invalidates old briefs
+PROMPT_HASH = hashlib.blake2b(BRIEF_PROMPT.encode("utf-8"), digest_size=4).hexdigest()
+
+# Build the model once instead of per request
+model = genai.GenerativeModel(MODEL_NAME)
+
+# Maps PDF content hash -> (uploaded Gemini file, upload timestamp)
+_FILE_CACHE: dict[str, tuple[genai.types.File, float]] = {}
+
+# Backpressure so concurrent requests don't trip Gemini's rate limit
+_GEMINI_SEM = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+def hash_pdf(pdf_data: bytearray) -> str:
+    """Returns a content hash of the PDF, used as the upload cache key."""
+    return hashlib.blake2b(pdf_data, digest_size=16).hexdigest()
+
+def _summary_cache_path(pdf_hash: str) -> Path:
+    return SUMMARY_CACHE_DIR / f"{pdf_hash}-{MODEL_NAME}-{PROMPT_HASH}.md"
+
+def load_cached_summary(pdf_hash: str) -> str | None:
+    """Returns the stored brief for this PDF, or None on a cache miss."""
+    path = _summary_cache_path(pdf_hash)
+    try:
+        summary = path.read_text(encoding="utf-8")
+        # Bump mtime so eviction treats this entry as recently used
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        # The cache is only an optimisation; fall through to Gemini
+        logger.warning(f"Could not read cached brief for {pdf_hash}: {e}")
+        return None
+    return summary
+
+def store_summary(pdf_hash: str, summary: str):
+    """Writes the brief to the cache and evicts least recently used entries."""
+    SUMMARY_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path = _summary_cache_path(pdf_hash)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(summary, encoding="utf-8")
+    os.replace(tmp_path, path)
+
+    entries = sorted(SUMMARY_CACHE_DIR.glob("*.md"), key=lambda p: p.stat().st_mtime, reverse=True)
+    total = 0
+    for entry in entries:
+        total += entry.stat().st_size
+        if total > SUMMARY_CACHE_MAX_BYTES:
+            entry.unlink(missing_ok=True)
+
+async def process_pdf(pdf_data: bytearray) -> str:
+    """Uploads PDF to Gemini and gets the editorial analysis."""
+    # Hashing and uploading are blocking calls, so run them in a thread
+    loop = asyncio.get_running_loop()
+    pdf_hash = await loop.run_in_executor(None, hash_pdf, pdf_data)
+
+    summary = await loop.run_in_executor(None, load_cached_summary, pdf_hash)
+    if summary is not None:
+        logger.info(f"Serving cached brief for {pdf_hash}")
+        return summary
     
-    response = await model.generate_content_async([gemini_file, prompt])
+    # Define a helper for the blocking upload call
+    def upload_and_wait():
+        # Upload straight from memory; the PDF never touches the disk
+        sample_file = genai.upload_file(
+            io.BytesIO(pdf_data), mime_type="application/pdf", display_name="newspaper.pdf"
+        )
+        # Wait for processing to complete. 
+        # For small PDFs it's instant, but safe to check.
+        while sample_file.state.name == "PROCESSING":
+             time.sleep(1)
+             sample_file = genai.get_file(sample_file.name)
+        return sample_file
+
+    async def upload():
+        logger.info(f"Uploading file to Gemini: {pdf_hash} ({len(pdf_data)} bytes)")
+        gemini_file = await loop.run_in_executor(None, upload_and_wait)
+
+        if gemini_file.state.name == "FAILED":
+            raise ValueError("Gemini failed to process the PDF file.")
+
+        now = time.time()
+        for key in [k for k, (_, ts) in _FILE_CACHE.items() if now - ts >= FILE_CACHE_TTL]:
+            del _FILE_CACHE[key]
+        _FILE_CACHE[pdf_hash] = (gemini_file, now)
+        logger.info(f"File uploaded: {gemini_file.name}")
+        return gemini_file
+
+    async def generate(gemini_file):
+        # Retry rate-limit (429) errors with exponential backoff
+        async with _GEMINI_SEM:
+            async for attempt in AsyncRetrying(
+                wait=wait_exponential(multiplier=1, max=30),
+                retry=retry_if_exception_type(ResourceExhausted),
+                stop=stop_after_attempt(5),
+                reraise=True,
+            ):
+                with attempt:
+                    return await model.generate_content_async([gemini_file, BRIEF_PROMPT])
+
+    cached = _FILE_CACHE.get(pdf_hash)
+    if cached and time.time() - cached[1] < FILE_CACHE_TTL:
+        gemini_file = cached[0]
+        logger.info(f"Reusing uploaded file: {gemini_file.name}")
+        try:
+            response = await generate(gemini_file)
+        except (NotFound, PermissionDenied) as e:
+            # The remote file went away before our TTL did; upload it again once
+            logger.warning(f"Cached file {gemini_file.name} is unusable ({e}), re-uploading")
+            _FILE_CACHE.pop(pdf_hash, None)
+            response = await generate(await upload())
+    else:
+        response = await generate(await upload())
     
     # Cleanup (Optional but good practice to delete file from cloud storage)
     # genai.delete_file(gemini_file.name) # Deferring for now to keep it simple/fast
     
-    return response.text
+    summary = response.text
+    # Don't pin a miss; a retry may well find the section
+    if NOT_FOUND_REPLY not in summary:
+        try:
+            await loop.run_in_executor(None, store_summary, pdf_hash, summary)
+        except OSError as e:
+            logger.warning(f"Could not cache brief for {pdf_hash}: {e}")
+    
+    return summary
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -104,25 +210,27 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     status_msg = await update.message.reply_text(f"Processing {file_size_mb:.2f} MB file... (Uploading to Brain)")
     
     try:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Download file
-            logger.info(f"Downloading file: {update.message.document.file_id} ({file_size_mb:.2f} MB)")
-            file = await context.bot.get_file(update.message.document.file_id)
-            pdf_path = os.path.join(temp_dir, "newspaper.pdf")
-            await file.download_to_drive(pdf_path)
-            
-            # Process with Gemini
-            await status_msg.edit_text("Reading newspaper (Gemini 2.0 Flash is analyzing)...")
-            summary = await process_pdf(pdf_path)
-            
-            await status_msg.edit_text("Here is your Decision-Maker’s Brief:")
-            await update.message.reply_text(summary, parse_mode=ParseMode.MARKDOWN)
-            logger.info("Process complete.")
+        # Download file into memory
+        logger.info(f"Downloading file: {update.message.document.file_id} ({file_size_mb:.2f} MB)")
+        file = await context.bot.get_file(update.message.document.file_id)
+        pdf_data = await file.download_as_bytearray()
+        
+        # Process with Gemini
+        await status_msg.edit_text("Reading newspaper (Gemini 2.0 Flash is analyzing)...")
+        summary = await process_pdf(pdf_data)
+        
+        await status_msg.edit_text("Here is your Decision-Maker’s Brief:")
+        await update.message.reply_text(summary, parse_mode=ParseMode.MARKDOWN)
+        logger.info("Process complete.")
 
     except Exception as e:
         logger.error(f"Error processing PDF: {e}", exc_info=True)
         await status_msg.edit_text(f"An error occurred: {str(e)}")
 
+async def post_init(application):
+    # Size the default executor used by run_in_executor(None, ...)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE))
+
 def main():
     if not TELEGRAM_BOT_TOKEN or not GEMINI_API_KEY:
         print("Error: TELEGRAM_BOT_TOKEN and GEMINI_API_KEY must be set in .env file.")
@@ -132,7 +240,7 @@ def main():
     from telegram.request import HTTPXRequest
     request = HTTPXRequest(connection_pool_size=8, read_timeout=300, write_timeout=300, connect_timeout=60)
 
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).request(request).build()
+    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).request(request).post_init(post_init).build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.Document.PDF, handle_document))